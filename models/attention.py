@@ -3,13 +3,73 @@
 # This source code is licensed under the Apache 2.0 License license found in the
 # LICENSE file in the root directory of this source tree.
 
+import math
 import torch
-import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.nn.init as init
 from torch import Tensor
 from models.modules import Linear
-from typing import Tuple, Optional, Any
+from typing import Tuple, Optional, Any, Dict
+
+# fused attention kernels (FlashAttention / memory-efficient) are available, callers can then leave causality to them
+FUSED_ATTENTION_AVAILABLE = hasattr(F, 'scaled_dot_product_attention')
+
+
+# causal masks are identical for every batch, so one (max_len x max_len) mask per device is kept and sliced
+_causal_mask_cache: Dict[torch.device, Tensor] = dict()
+
+
+def get_causal_mask(size: int, device: torch.device) -> Tensor:
+    """
+    Returns a (size x size) mask whose future positions are set to True, sliced from a cached mask.
+
+    Examples::
+        >>> get_causal_mask(4, device)
+        tensor([[False,  True,  True,  True],
+                [False, False,  True,  True],
+                [False, False, False,  True],
+                [False, False, False, False]])
+    """
+    causal_mask = _causal_mask_cache.get(device)
+
+    if causal_mask is None or causal_mask.size(0) < size:
+        positions = torch.arange(size, device=device)
+        causal_mask = positions.unsqueeze(0) > positions.unsqueeze(1)
+        _causal_mask_cache[device] = causal_mask
+
+    return causal_mask[:size, :size]
+
+
+def _scaled_dot_product_attention(
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        mask: Optional[Tensor],
+        scale: float,
+) -> Tuple[Tensor, Tensor]:
+    """
+    Unfused attention that also returns the weights. A pure tensor function without module state,
+    so ``torch.compile(model, dynamic=True)`` can trace it in one graph and fuse the softmax with the matmuls.
+    """
+    batch_shape, q_len, k_len = query.shape[:-2], query.size(-2), key.size(-2)
+
+    # batched matmuls work on 3-D tensors, so fold any leading (batch, head) dimensions
+    query = query.reshape(-1, q_len, query.size(-1))
+    key = key.reshape(-1, k_len, key.size(-1))
+    value = value.reshape(-1, k_len, value.size(-1))
+
+    # scale inside the GEMM epilogue instead of a separate pass over the scores
+    score = torch.empty(query.size(0), q_len, k_len, dtype=query.dtype, device=query.device)
+    score = torch.baddbmm(score, query, key.transpose(1, 2), beta=0, alpha=scale)
+
+    if mask is not None:
+        # the mask may be broadcast over heads, so fill through a view with the original leading dimensions
+        score.view(*batch_shape, q_len, k_len).masked_fill_(mask, -1e9)
+
+    attn = F.softmax(score, -1)
+    context = torch.bmm(attn, value)
+    return context.view(*batch_shape, q_len, -1), attn.view(*batch_shape, q_len, k_len)
 
 
 class ScaledDotProductAttention(nn.Module):
@@ -18,9 +78,12 @@ class ScaledDotProductAttention(nn.Module):
     Compute the dot products of the query with all keys, divide each by sqrt(dim),
     and apply a softmax function to obtain the weights on the values
 
-    Args: dim, mask
+    If available, ``torch.nn.functional.scaled_dot_product_attention`` is used, which dispatches to the
+    fused (FlashAttention / memory-efficient) kernels and never materializes the attention weights.
+
+    Args: dim, need_weights
         dim (int): dimension of attention
-        mask (torch.Tensor): tensor containing indices to be masked
+        need_weights (bool): if True, the attention weights are computed and returned (default: False)
 
     Inputs: query, key, value, mask
         - **query** (batch, q_len, d_model): tensor containing projection vector for decoder.
@@ -28,23 +91,50 @@ class ScaledDotProductAttention(nn.Module):
         - **value** (batch, v_len, d_model): tensor containing features of the encoded input sequence.
         - **mask** (-): tensor containing indices to be masked
 
+        Inputs may also carry extra leading dimensions, e.g. (batch, num_heads, q_len, d_head).
+
+        With ``is_causal``, every query position is additionally kept from attending to later key positions.
+        Given without a mask, the fused kernel applies causality itself and no (q_len x k_len) mask is built.
+
     Returns: context, attn
         - **context**: tensor containing the context vector from attention mechanism.
         - **attn**: tensor containing the attention (alignment) from the encoder outputs.
+          ``None`` if ``need_weights`` is False and the fused kernel is used.
     """
-    def __init__(self, dim: int) -> None:
+    def __init__(self, dim: int, need_weights: bool = False) -> None:
         super(ScaledDotProductAttention, self).__init__()
-        self.sqrt_dim = np.sqrt(dim)
-
-    def forward(self, query: Tensor, key: Tensor, value: Tensor, mask: Optional[Any] = None) -> Tuple[Tensor, Tensor]:
-        score = torch.bmm(query, key.transpose(1, 2)) / self.sqrt_dim
-
-        if mask is not None:
-            score.masked_fill_(mask, -1e9)
-
-        attn = F.softmax(score, -1)
-        context = torch.bmm(attn, value)
-        return context, attn
+        self.scale = 1.0 / math.sqrt(dim)
+        self.need_weights = need_weights
+
+    def forward(
+            self,
+            query: Tensor,
+            key: Tensor,
+            value: Tensor,
+            mask: Optional[Any] = None,
+            is_causal: bool = False,
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        use_fused = not self.need_weights and FUSED_ATTENTION_AVAILABLE
+
+        if is_causal and (mask is not None or not use_fused):
+            # the fused kernel rejects is_causal together with an explicit mask, so causality goes into the mask
+            q_len, k_len = query.size(-2), key.size(-2)
+            causal_mask = get_causal_mask(max(q_len, k_len), query.device)[:q_len, :k_len]
+            mask = causal_mask if mask is None else mask | causal_mask
+            is_causal = False
+
+        if use_fused:
+            default_scale = 1.0 / math.sqrt(query.size(-1))
+            if self.scale != default_scale:
+                # the fused kernel scales by 1 / sqrt(query.size(-1)), so the difference to dim is folded into the query
+                query = query * (self.scale / default_scale)
+
+            # fused kernels take a boolean mask of positions allowed to attend
+            attn_mask = ~mask if mask is not None else None
+            context = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, is_causal=is_causal)
+            return context, None
+
+        return _scaled_dot_product_attention(query, key, value, mask, self.scale)
 
 
 class MultiHeadAttention(nn.Module):
@@ -62,50 +152,83 @@ class MultiHeadAttention(nn.Module):
     Args:
         d_model (int): The dimension of keys / values / quries (default: 512)
         num_heads (int): The number of attention heads. (default: 8)
+        need_weights (bool): if True, the attention weights are computed and returned (default: False)
 
     Inputs: query, key, value, mask
         - **query** (batch, q_len, d_model): tensor containing projection vector for decoder.
         - **key** (batch, k_len, d_model): tensor containing projection vector for encoder.
         - **value** (batch, v_len, d_model): tensor containing features of the encoded input sequence.
         - **mask** (-): tensor containing indices to be masked
+        - **is_causal** (bool): if True, query positions do not attend to later key positions (default: False)
 
     Returns: output, attn
         - **output** (batch, output_len, dimensions): tensor containing the attended output features.
-        - **attn** (batch * num_heads, v_len): tensor containing the attention (alignment) from the encoder outputs.
+        - **attn** (batch, num_heads, q_len, v_len): tensor containing the attention (alignment) from the encoder outputs.
+          ``None`` if ``need_weights`` is False and the fused kernel is used.
     """
-    def __init__(self, d_model: int = 512, num_heads: int = 8) -> None:
+    def __init__(self, d_model: int = 512, num_heads: int = 8, need_weights: bool = False) -> None:
         super(MultiHeadAttention, self).__init__()
 
         assert d_model % num_heads == 0, "hidden_dim % num_heads should be zero."
 
         self.d_head = int(d_model / num_heads)
         self.num_heads = num_heads
-        self.query_proj = Linear(d_model, self.d_head * num_heads)
-        self.key_proj = Linear(d_model, self.d_head * num_heads)
-        self.value_proj = Linear(d_model, self.d_head * num_heads)
-        self.sqrt_dim = np.sqrt(d_model)
-        self.scaled_dot_attn = ScaledDotProductAttention(self.d_head)
-
-    def forward(self, query: Tensor, key: Tensor, value: Tensor, mask: Optional[Any] = None) -> Tuple[Tensor, Tensor]:
+        self.d_model = d_model
+        # query, key and value projections stacked in one weight, so self-attention issues a single GEMM
+        self.qkv_proj = Linear(d_model, 3 * self.d_head * num_heads)
+        for weight in self.qkv_proj.linear.weight.chunk(3):
+            init.xavier_uniform_(weight)
+        self.scaled_dot_attn = ScaledDotProductAttention(self.d_head, need_weights)
+
+    def forward(
+            self,
+            query: Tensor,
+            key: Tensor,
+            value: Tensor,
+            mask: Optional[Any] = None,
+            is_causal: bool = False,
+    ) -> Tuple[Tensor, Optional[Tensor]]:
         batch_size = value.size(0)
+        query, key, value = self._project(query, key, value)
 
-        query = self.query_proj(query).view(batch_size, -1, self.num_heads, self.d_head)  # BxQ_LENxNxD
-        key = self.key_proj(key).view(batch_size, -1, self.num_heads, self.d_head)        # BxK_LENxNxD
-        value = self.value_proj(value).view(batch_size, -1, self.num_heads, self.d_head)  # BxV_LENxNxD
-
-        query = query.permute(2, 0, 1, 3).contiguous().view(batch_size * self.num_heads, -1, self.d_head)  # BNxQ_LENxD
-        key = key.permute(2, 0, 1, 3).contiguous().view(batch_size * self.num_heads, -1, self.d_head)      # BNxK_LENxD
-        value = value.permute(2, 0, 1, 3).contiguous().view(batch_size * self.num_heads, -1, self.d_head)  # BNxV_LENxD
+        query = query.view(batch_size, -1, self.num_heads, self.d_head).transpose(1, 2)  # BxNxQ_LENxD
+        key = key.view(batch_size, -1, self.num_heads, self.d_head).transpose(1, 2)      # BxNxK_LENxD
+        value = value.view(batch_size, -1, self.num_heads, self.d_head).transpose(1, 2)  # BxNxV_LENxD
 
         if mask is not None:
-            mask = mask.repeat(self.num_heads, 1, 1)
+            mask = mask.unsqueeze(1)  # Bx1xQ_LENxK_LEN, broadcast over heads
 
-        context, attn = self.scaled_dot_attn(query, key, value, mask)
-        context = context.view(self.num_heads, batch_size, -1, self.d_head)
-        context = context.permute(1, 2, 0, 3).contiguous().view(batch_size, -1, self.num_heads * self.d_head)  # BxTxND
+        context, attn = self.scaled_dot_attn(query, key, value, mask, is_causal)
+        context = context.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.d_head)  # BxTxND
 
         return context, attn
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the fused projection hold separate query / key / value projections
+        for param in ('weight', 'bias'):
+            keys = ['{0}{1}_proj.linear.{2}'.format(prefix, name, param) for name in ('query', 'key', 'value')]
+
+            if all(key in state_dict for key in keys):
+                fused = torch.cat([state_dict.pop(key) for key in keys])
+                state_dict['{0}qkv_proj.linear.{1}'.format(prefix, param)] = fused
+
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _project(self, query: Tensor, key: Tensor, value: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        if query is key and key is value:  # self-attention
+            return self.qkv_proj(query).chunk(3, dim=-1)
+
+        weight, bias = self.qkv_proj.linear.weight, self.qkv_proj.linear.bias
+        query = F.linear(query, weight[:self.d_model], bias[:self.d_model])
+
+        if key is value:  # attention over a memory, e.g. encoder outputs
+            key, value = F.linear(key, weight[self.d_model:], bias[self.d_model:]).chunk(2, dim=-1)
+        else:
+            key = F.linear(key, weight[self.d_model:-self.d_model], bias[self.d_model:-self.d_model])
+            value = F.linear(value, weight[-self.d_model:], bias[-self.d_model:])
+
+        return query, key, value
+
 
 class LocationAwareAttention(nn.Module):
     """
@@ -118,6 +241,10 @@ class LocationAwareAttention(nn.Module):
         decoder_dim (int): dimension of model
         attn_dim (int): dimension of attention
         smoothing (bool): flag indication whether to use smoothing or not.
+        num_location_filters (int, optional): if given, the location convolution uses this many filters with
+            location_kernel_size, followed by a projection to attn_dim. Otherwise the original attn_dim filters of
+            size 3 are used. (default: None)
+        location_kernel_size (int): kernel size of the location convolution with num_location_filters (default: 31)
 
     Inputs: query, value, last_attn
         - **query** (batch, q_len, hidden_dim): tensor containing the output features from the decoder.
@@ -132,11 +259,30 @@ class LocationAwareAttention(nn.Module):
         - **Attention-Based Models for Speech Recognition**: https://arxiv.org/abs/1506.07503
         - **ClovaCall**: https://github.com/clovaai/ClovaCall/blob/master/las.pytorch/models/attention.py
     """
-    def __init__(self, decoder_dim: int = 1024, attn_dim: int = 1024, smoothing: bool = False) -> None:
+    def __init__(
+            self,
+            decoder_dim: int = 1024,
+            attn_dim: int = 1024,
+            smoothing: bool = False,
+            num_location_filters: Optional[int] = None,
+            location_kernel_size: int = 31,
+    ) -> None:
         super(LocationAwareAttention, self).__init__()
         self.decoder_dim = decoder_dim
         self.attn_dim = attn_dim
-        self.location_conv = nn.Conv1d(in_channels=1, out_channels=attn_dim, kernel_size=3, padding=1)
+
+        if num_location_filters is None:
+            self.location_conv = nn.Conv1d(in_channels=1, out_channels=attn_dim, kernel_size=3, padding=1)
+            self.location_proj = None
+        else:
+            self.location_conv = nn.Conv1d(
+                in_channels=1,
+                out_channels=num_location_filters,
+                kernel_size=location_kernel_size,
+                padding=location_kernel_size // 2,
+            )
+            self.location_proj = Linear(num_location_filters, attn_dim, bias=False)
+
         self.query_proj = Linear(decoder_dim, attn_dim, bias=False)
         self.value_proj = Linear(decoder_dim, attn_dim, bias=False)
         self.bias = nn.Parameter(torch.rand(attn_dim).uniform_(-0.1, 0.1))
@@ -149,8 +295,10 @@ class LocationAwareAttention(nn.Module):
         if last_alignment_energy is None:
             last_alignment_energy = value.new_zeros(batch_size, seq_length)
 
-        last_alignment_energy = self.location_conv(last_alignment_energy.unsqueeze(dim=1))
-        last_alignment_energy = last_alignment_energy.transpose(1, 2)
+        last_alignment_energy = self.location_conv(last_alignment_energy.unsqueeze(dim=1)).transpose(1, 2)
+
+        if self.location_proj is not None:
+            last_alignment_energy = self.location_proj(last_alignment_energy)
 
         alignmment_energy = self.fc(torch.tanh(
                 self.query_proj(query)
@@ -160,13 +308,13 @@ class LocationAwareAttention(nn.Module):
         )).squeeze(dim=-1)
 
         if self.smoothing:
-            alignmment_energy = torch.sigmoid(alignmment_energy)
-            alignmment_energy = torch.div(alignmment_energy, alignmment_energy.sum(dim=-1).unsqueeze(dim=-1))
+            alignmment_energy = F.normalize(torch.sigmoid(alignmment_energy), p=1, dim=-1)
 
         else:
             alignmment_energy = F.softmax(alignmment_energy, dim=-1)
 
-        context = torch.bmm(alignmment_energy.unsqueeze(dim=1), value)
+        # a single decoder step attends over the encoder outputs, so contract directly instead of a 1-row bmm
+        context = torch.einsum('bv,bvd->bd', alignmment_energy, value).unsqueeze(dim=1)
 
         return context, alignmment_energy
 
@@ -200,7 +348,7 @@ class AdditiveAttention(nn.Module):
     def forward(self, query: Tensor, key: Tensor, value: Tensor) -> Tuple[Tensor, Tensor]:
         score = self.score_proj(torch.tanh(self.key_proj(key) + self.query_proj(query) + self.bias)).squeeze(-1)
         attn = F.softmax(score, dim=-1)
-        context = torch.bmm(attn.unsqueeze(1), value)
+        context = torch.einsum('bv,bvd->bd', attn, value).unsqueeze(1)
 
         context += query
 
@@ -66,6 +66,5 @@ class JasperDecoder(nn.Module):
             output, output_lengths = layer(output, output_lengths)
 
         output = F.log_softmax(output.transpose(1, 2), dim=-1)
-        del encoder_outputs, encoder_output_lengths
 
         return output, output_lengths
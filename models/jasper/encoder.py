@@ -84,7 +84,6 @@ class JasperEncoder(nn.Module):
             residual = self._get_jasper_dencse_residual(prev_outputs, prev_output_lengths, i)
 
         output, output_lengths = self.layers[-1](inputs, input_lengths, residual)
-        del prev_outputs, prev_output_lengths, residual, inputs, input_lengths
 
         return output, output_lengths
 
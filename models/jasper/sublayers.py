@@ -14,11 +14,38 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from typing import Tuple, Optional
 from torch import Tensor
 
 
+@torch.jit.script
+def _residual_activation_dropout(
+        inputs: Tensor,
+        residual: Optional[Tensor],
+        activation: str,
+        dropout_p: float,
+        training: bool,
+) -> Tensor:
+    """ Elementwise tail of a Jasper sub-block, scripted so the fuser can merge it into one kernel """
+    if residual is not None:
+        inputs = inputs + residual
+
+    if activation == 'relu':
+        inputs = F.relu(inputs)
+    elif activation == 'hardtanh':
+        inputs = F.hardtanh(inputs, 0.0, 20.0)
+    elif activation == 'elu':
+        inputs = F.elu(inputs)
+    elif activation == 'leaky_relu':
+        inputs = F.leaky_relu(inputs)
+    else:
+        inputs = F.gelu(inputs)
+
+    return F.dropout(inputs, dropout_p, training)
+
+
 class MaskConv1d(nn.Conv1d):
     """1D convolution with sequence masking """
     def __init__(
@@ -35,8 +62,14 @@ class MaskConv1d(nn.Conv1d):
         super(MaskConv1d, self).__init__(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size,
                                          stride=stride, padding=padding, dilation=dilation,
                                          groups=groups, bias=bias)
+        self.register_buffer('_arange_cache', torch.empty(0, dtype=torch.long), persistent=False)
+        # "same" convolutions, i.e. every Jasper block conv and the 1x1 residual convs, keep the lengths as is
+        self.preserves_length = stride == 1 and 2 * padding == dilation * (kernel_size - 1)
 
     def get_sequence_lengths(self, seq_lengths):
+        if self.preserves_length:
+            return seq_lengths
+
         return (
             (seq_lengths + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
         )
@@ -48,16 +81,17 @@ class MaskConv1d(nn.Conv1d):
         """
         max_length = inputs.size(2)
 
-        indices = torch.arange(max_length).to(input_lengths.dtype).to(input_lengths.device)
-        indices = indices.expand(len(input_lengths), max_length)
+        # un-padded batches need no masking at all, checked only for host lengths as it would sync with the device
+        if input_lengths.device.type != 'cpu' or (input_lengths != max_length).any():
+            if self._arange_cache.numel() < max_length:
+                self._arange_cache = torch.arange(max_length, device=inputs.device)
 
-        mask = indices >= input_lengths.unsqueeze(1)
-        inputs = inputs.masked_fill(mask.unsqueeze(1).to(device=inputs.device), 0)
+            # multiplicative mask in the activation dtype; unlike masked_fill, it is kept alive for backward
+            non_pad_mask = self._arange_cache[:max_length] < input_lengths.to(inputs.device).unsqueeze(1)
+            inputs = inputs * non_pad_mask.unsqueeze(1).to(inputs.dtype)
 
         output_lengths = self.get_sequence_lengths(input_lengths)
-        output = super(MaskConv1d, self).forward(inputs)
-
-        del mask, indices
+        output = F.conv1d(inputs, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
 
         return output, output_lengths
 
@@ -152,13 +186,7 @@ class JasperSubBlock(nn.Module):
         - **output**: tensor contains output sequence vector
         - **output**: tensor contains output sequence lengths
     """
-    supported_activations = {
-        'hardtanh': nn.Hardtanh(0, 20, inplace=True),
-        'relu': nn.ReLU(inplace=True),
-        'elu': nn.ELU(inplace=True),
-        'leaky_relu': nn.LeakyReLU(inplace=True),
-        'gelu': nn.GELU()
-    }
+    supported_activations = ('hardtanh', 'relu', 'elu', 'leaky_relu', 'gelu')
 
     def __init__(
             self,
@@ -184,17 +212,16 @@ class JasperSubBlock(nn.Module):
             dilation=dilation
         )
         self.batch_norm = nn.BatchNorm1d(out_channels, eps=1e-3, momentum=0.1)
-        self.activation = self.supported_activations[activation]
-        self.dropout = nn.Dropout(p=dropout_p)
+
+        if activation not in self.supported_activations:
+            raise ValueError("Unsupported activation : {0}".format(activation))
+
+        self.activation = activation
+        self.dropout_p = dropout_p
 
     def forward(self, inputs: Tensor, input_lengths: Tensor, residual: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
         output, output_lengths = self.conv(inputs, input_lengths)
         output = self.batch_norm(output)
-
-        if residual is not None:
-            output += residual
-
-        output = self.dropout(self.activation(output))
-        del inputs, input_lengths, residual
+        output = _residual_activation_dropout(output, residual, self.activation, self.dropout_p, self.training)
 
         return output, output_lengths
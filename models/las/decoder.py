@@ -49,6 +49,8 @@ class Speller(BaseRNN):
 
     Returns: decoder_outputs
         - **decoder_outputs**: dictionary contains decoder outputs and metadata the outputs of the decoding function.
+          In evaluation, ``attention_score`` holds one alignment per step, shaped (batch, num_heads, 1, v_len)
+          for multi-head attention and (batch, 1, v_len) for scaled-dot attention.
     """
 
     def __init__(
@@ -81,11 +83,11 @@ class Speller(BaseRNN):
         if self.attn_mechanism == 'loc':
             self.attention = LocationAwareAttention(decoder_dim=hidden_dim, attn_dim=hidden_dim, smoothing=False)
         elif self.attn_mechanism == 'multi-head':
-            self.attention = MultiHeadAttention(d_model=hidden_dim, num_heads=num_heads)
+            self.attention = MultiHeadAttention(d_model=hidden_dim, num_heads=num_heads, need_weights=True)
         elif self.attn_mechanism == 'additive':
             self.attention = AdditiveAttention(hidden_dim)
         elif self.attn_mechanism == 'scaled-dot':
-            self.attention = ScaledDotProductAttention(dim=hidden_dim)
+            self.attention = ScaledDotProductAttention(dim=hidden_dim, need_weights=True)
         else:
             raise ValueError("Unsupported attention: %s".format(attn_mechanism))
 
@@ -11,7 +11,6 @@ from typing import Tuple, Optional
 from models.modules import (
     BaseRNN,
     Linear,
-    Transpose
 )
 from models.extractor import (
     VGGExtractor,
@@ -19,6 +18,20 @@ from models.extractor import (
 )
 
 
+@torch.jit.script
+def _time_last_to_batch_first(conv_feat: Tensor) -> Tensor:
+    """ (batch, channel, hidden, time) -> (batch, time, channel * hidden) as a strided view, without a copy """
+    batch_size, num_channels, hidden_dim, seq_length = conv_feat.size()
+    return conv_feat.reshape(batch_size, num_channels * hidden_dim, seq_length).transpose(1, 2)
+
+
+@torch.jit.script
+def _to_batch_first(conv_feat: Tensor) -> Tensor:
+    """ (batch, channel, time, hidden) -> (batch, time, channel * hidden) with a single copy """
+    batch_size, num_channels, seq_length, hidden_dim = conv_feat.size()
+    return conv_feat.movedim(1, 2).reshape(batch_size, seq_length, num_channels * hidden_dim)
+
+
 class Listener(BaseRNN):
     """
     Converts low level speech signals into higher level features
@@ -34,10 +47,12 @@ class Listener(BaseRNN):
         device (torch.device): device - 'cuda' or 'cpu'
         activation (str): type of activation function (default: hardtanh)
         mask_conv (bool): flag indication whether apply mask convolution or not
+        amp (bool): if True, runs the extractor, RNN and CTC head under bfloat16 autocast (default: False)
 
     Inputs: inputs, input_lengths
         - **inputs**: list of sequences, whose length is the batch size and within which each sequence is list of tokens
-        - **input_lengths**: list of sequence lengths
+        - **input_lengths**: list of sequence lengths. Keep them on the CPU (as the data loader yields them),
+          pack_padded_sequence needs host lengths and would otherwise synchronize with the device.
 
     Returns: encoder_outputs, hidden
         - **encoder_outputs**: tensor containing the encoded features of the input sequence
@@ -56,9 +71,11 @@ class Listener(BaseRNN):
             extractor: str = 'vgg',                  # type of CNN extractor
             activation: str = 'hardtanh',            # type of activation function
             mask_conv: bool = False,                 # flag indication whether apply mask convolution or not
-            joint_ctc_attention: bool = False        # Use CTC Loss & Cross Entropy Joint Learning
+            joint_ctc_attention: bool = False,       # Use CTC Loss & Cross Entropy Joint Learning
+            amp: bool = False                        # if True, runs under bfloat16 autocast
     ) -> None:
         self.mask_conv = mask_conv
+        self.amp = amp
         self.extractor = extractor.lower()
         self.joint_ctc_attention = joint_ctc_attention
 
@@ -85,41 +102,93 @@ class Listener(BaseRNN):
             assert self.mask_conv, "if joint_ctc_attention training, mask_conv should be True"
             self.fc = nn.Sequential(
                 nn.BatchNorm1d(self.hidden_dim << 1),
-                Transpose(shape=(1, 2)),
                 nn.Dropout(dropout_p),
                 Linear(self.hidden_dim << 1, num_classes, bias=False)
             )
+            self.fc_dtype = None  # set by inference(), until then the head takes the RNN outputs as they are
 
     def forward(self, inputs: Tensor, input_lengths: Tensor) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
         encoder_log_probs = None
         encoder_output_lengths = None
 
-        if self.mask_conv:
-            inputs = inputs.unsqueeze(1).permute(0, 1, 3, 2)
-            conv_feat, encoder_output_lengths = self.conv(inputs, input_lengths)
+        # weights stay in float32, autocast runs the conv / RNN / linear GEMMs in bfloat16
+        with torch.autocast(device_type=inputs.device.type, dtype=torch.bfloat16, enabled=self.amp):
+            if self.mask_conv:
+                inputs = inputs.unsqueeze(1).permute(0, 1, 3, 2)
+                conv_feat, encoder_output_lengths = self.conv(inputs, input_lengths)
+                conv_feat = _time_last_to_batch_first(conv_feat)
+
+                # packing gathers the frames anyway, so batch-first avoids both a layout copy and a final transpose
+                conv_feat = nn.utils.rnn.pack_padded_sequence(conv_feat, encoder_output_lengths.cpu(), batch_first=True)
+                packed_outputs, hidden = self.rnn(conv_feat)
+                encoder_outputs, _ = nn.utils.rnn.pad_packed_sequence(packed_outputs, batch_first=True)
+
+                if self.joint_ctc_attention:
+                    # CTC head runs on the packed (sum_T, C) frames, so padding never reaches batch norm or linear
+                    fc_inputs = packed_outputs.data if self.fc_dtype is None else packed_outputs.data.to(self.fc_dtype)
+                    encoder_log_probs = self.fc(fc_inputs).float().log_softmax(dim=-1)
+                    encoder_log_probs = nn.utils.rnn.PackedSequence(
+                        encoder_log_probs,
+                        packed_outputs.batch_sizes,
+                        packed_outputs.sorted_indices,
+                        packed_outputs.unsorted_indices,
+                    )
+                    encoder_log_probs, _ = nn.utils.rnn.pad_packed_sequence(encoder_log_probs, batch_first=True)
+
+            else:
+                conv_feat = self.conv(inputs.unsqueeze(1), input_lengths).to(self.device)
+                conv_feat = _to_batch_first(conv_feat)
+
+                if self.training:
+                    self.rnn.flatten_parameters()
+
+                encoder_outputs, hidden = self.rnn(conv_feat)
+
+        if self.amp:
+            encoder_outputs = encoder_outputs.float()
 
-            batch_size, num_channels, hidden_dim, seq_length = conv_feat.size()
-            conv_feat = conv_feat.view(batch_size, num_channels * hidden_dim, seq_length).permute(2, 0, 1).contiguous()
+        return encoder_outputs, encoder_log_probs, encoder_output_lengths
 
-            conv_feat = nn.utils.rnn.pack_padded_sequence(conv_feat, encoder_output_lengths.cpu())
-            encoder_outputs, hidden = self.rnn(conv_feat)
-            encoder_outputs, _ = nn.utils.rnn.pad_packed_sequence(encoder_outputs)
-            encoder_outputs = encoder_outputs.transpose(0, 1)
+    def inference(self) -> 'Listener':
+        """
+        Switches to evaluation mode, folds the batch norm of the CTC head into its linear layer
+        and lowers the precision of the head for inference.
+        On CUDA the head runs in bfloat16, on CPU its linear layer is dynamically quantized to int8.
+        The log-softmax is computed in float32 either way.
+        """
+        self.eval()
 
-        else:
-            conv_feat = self.conv(inputs.unsqueeze(1), input_lengths).to(self.device)
-            conv_feat = conv_feat.transpose(1, 2)
+        if self.joint_ctc_attention:
+            self.fuse_bn_linear()
 
-            batch_size, seq_length, num_channels, hidden_dim = conv_feat.size()
-            conv_feat = conv_feat.contiguous().view(batch_size, seq_length, num_channels * hidden_dim)
+            # decide from where the weights actually live, the device argument is only a default
+            if next(self.parameters()).device.type == 'cuda':
+                self.fc_dtype = torch.bfloat16
+                self.fc.to(self.fc_dtype)
+            else:
+                self.fc = torch.ao.quantization.quantize_dynamic(self.fc, {nn.Linear}, dtype=torch.qint8)
 
-            if self.training:
-                self.rnn.flatten_parameters()
+        return self
 
-            encoder_outputs, hidden = self.rnn(conv_feat)
+    def fuse_bn_linear(self) -> None:
+        """
+        Folds the batch norm of the CTC head into the following linear layer, leaving a single GEMM.
+        Only valid for inference, where batch norm applies its running statistics and dropout is the identity.
+        """
+        if not isinstance(self.fc[0], nn.BatchNorm1d):  # already fused
+            return
 
-        if self.joint_ctc_attention:
-            encoder_log_probs = self.fc(encoder_outputs.transpose(1, 2)).log_softmax(dim=2)
+        batch_norm, linear = self.fc[0], self.fc[-1].linear
+        fused = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
 
-        return encoder_outputs, encoder_log_probs, encoder_output_lengths
+        with torch.no_grad():
+            scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+            shift = batch_norm.bias - batch_norm.running_mean * scale
+
+            fused.weight.copy_(linear.weight * scale.unsqueeze(0))
+            fused.bias.copy_(torch.mv(linear.weight, shift))
+
+            if linear.bias is not None:
+                fused.bias.add_(linear.bias)
 
+        self.fc = nn.Sequential(fused)
@@ -7,6 +7,7 @@ import math
 import torch
 import torch.nn as nn
 from torch import Tensor
+from typing import Final
 
 
 class PositionalEncoding(nn.Module):
@@ -18,18 +19,27 @@ class PositionalEncoding(nn.Module):
     "Attention Is All You Need" use sine and cosine functions of different frequencies:
         PE_(pos, 2i)    =  sin(pos / power(10000, 2i / d_model))
         PE_(pos, 2i+1)  =  cos(pos / power(10000, 2i / d_model))
+
+    The encodings are computed in float32 and stored in ``dtype``, e.g. bfloat16 for mixed precision models.
     """
-    def __init__(self, d_model: int = 512, max_len: int = 5000) -> None:
+    def __init__(self, d_model: int = 512, max_len: int = 5000, dtype: torch.dtype = torch.float32) -> None:
         super(PositionalEncoding, self).__init__()
-        pe = torch.zeros(max_len, d_model, requires_grad=False)
         position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
+        angles = position * div_term
+        # every element is written below, so the buffer is left uninitialized, sin / cos land interleaved in place
+        pe = torch.empty(max_len, d_model // 2, 2)
+        torch.sin(angles, out=pe[:, :, 0])
+        torch.cos(angles, out=pe[:, :, 1])
+        pe = pe.view(1, max_len, d_model)
+        # row-major (1, max_len, d_model), so a (1, length, d_model) slice adds to (B, T, d_model) inputs without a copy
+        self.register_buffer('pe', pe.to(dtype).contiguous())
 
     def forward(self, length: int) -> Tensor:
+        """
+        Returns the (1 x length x d_model) encodings as a view of the buffer. Callers add it in place to a freshly
+        computed input, e.g. ``inputs.add_(positional_encoding(length))``, as the buffer never requires grad.
+        """
         return self.pe[:, :length]
 
 
@@ -39,10 +49,13 @@ class Embedding(nn.Module):
     to convert the input tokens and output tokens to vectors of dimension d_model.
     In the embedding layers, transformer multiply those weights by sqrt(d_model)
     """
+    sqrt_dim: Final[float]
+
     def __init__(self, num_embeddings: int, pad_id: int, d_model: int = 512) -> Tensor:
         super(Embedding, self).__init__()
         self.sqrt_dim = math.sqrt(d_model)
         self.embedding = nn.Embedding(num_embeddings, d_model, padding_idx=pad_id)
 
     def forward(self, inputs: Tensor) -> Tensor:
+        # (B, T, d_model) row-major, the layout the positional encoding slice is added onto
         return self.embedding(inputs) * self.sqrt_dim
@@ -3,6 +3,7 @@
 # This source code is licensed under the Apache 2.0 License license found in the
 # LICENSE file in the root directory of this source tree.
 
+import torch
 import torch.nn as nn
 from torch import Tensor
 from typing import Tuple, Optional, Any
@@ -24,6 +25,10 @@ class SpeechTransformerEncoderLayer(nn.Module):
         d_ff: dimension of feed forward network (default: 2048)
         dropout_p: probability of dropout (default: 0.3)
         ffnet_style: style of feed forward network [ff, conv] (default: ff)
+        pre_norm: if True, applies layer normalization before each sub-layer instead of after (default: False)
+        amp: if True, runs the layer under bfloat16 autocast and returns float32 outputs (default: False).
+            Otherwise outputs keep the dtype of the weights, e.g. for a model cast with ``half()``.
+            For float32 runs on Ampere or newer, callers may enable ``torch.backends.cuda.matmul.allow_tf32``.
     """
 
     def __init__(
@@ -32,16 +37,24 @@ class SpeechTransformerEncoderLayer(nn.Module):
             num_heads: int = 8,             # number of attention heads
             d_ff: int = 2048,               # dimension of feed forward network
             dropout_p: float = 0.3,         # probability of dropout
-            ffnet_style: str = 'ff'         # style of feed forward network
+            ffnet_style: str = 'ff',        # style of feed forward network
+            pre_norm: bool = False,         # if True, applies layer normalization before each sub-layer
+            amp: bool = False               # if True, runs under bfloat16 autocast
     ) -> None:
         super(SpeechTransformerEncoderLayer, self).__init__()
-        self.self_attention = AddNorm(MultiHeadAttention(d_model, num_heads), d_model)
-        self.feed_forward = AddNorm(PositionWiseFeedForwardNet(d_model, d_ff, dropout_p, ffnet_style), d_model)
+        self.amp = amp
+        self.self_attention = AddNorm(MultiHeadAttention(d_model, num_heads), d_model, pre_norm)
+        self.feed_forward = AddNorm(
+            PositionWiseFeedForwardNet(d_model, d_ff, dropout_p, ffnet_style), d_model, pre_norm
+        )
 
     def forward(self, inputs: Tensor, self_attn_mask: Optional[Any] = None) -> Tuple[Tensor, Tensor]:
-        output, attn = self.self_attention(inputs, inputs, inputs, self_attn_mask)
-        output = self.feed_forward(output)
-        return output, attn
+        # weights stay in float32, autocast runs the projection / feed forward GEMMs in bfloat16
+        with torch.autocast(device_type=inputs.device.type, dtype=torch.bfloat16, enabled=self.amp):
+            output, attn = self.self_attention(inputs, inputs, inputs, self_attn_mask)
+            output = self.feed_forward(output)
+
+        return (output.float() if self.amp else output), attn
 
 
 class SpeechTransformerDecoderLayer(nn.Module):
@@ -55,6 +68,13 @@ class SpeechTransformerDecoderLayer(nn.Module):
         d_ff: dimension of feed forward network (default: 2048)
         dropout_p: probability of dropout (default: 0.3)
         ffnet_style: style of feed forward network [ff, conv] (default: ff)
+        pre_norm: if True, applies layer normalization before each sub-layer instead of after (default: False)
+        amp: if True, runs the layer under bfloat16 autocast and returns float32 outputs (default: False).
+            For float32 runs on Ampere or newer, callers may enable ``torch.backends.cuda.matmul.allow_tf32``.
+
+    The layer never builds masks itself. The decoder stack builds self_attn_mask and memory_mask once per forward,
+    outside the layer loop, and passes the same tensors to every layer. Without a self_attn_mask, the self-attention
+    is run as causal by the fused kernel, otherwise the given mask is expected to be causal already.
     """
 
     def __init__(
@@ -63,12 +83,17 @@ class SpeechTransformerDecoderLayer(nn.Module):
             num_heads: int = 8,             # number of attention heads
             d_ff: int = 2048,               # dimension of feed forward network
             dropout_p: float = 0.3,         # probability of dropout
-            ffnet_style: str = 'ff'         # style of feed forward network
+            ffnet_style: str = 'ff',        # style of feed forward network
+            pre_norm: bool = False,         # if True, applies layer normalization before each sub-layer
+            amp: bool = False               # if True, runs under bfloat16 autocast
     ) -> None:
         super(SpeechTransformerDecoderLayer, self).__init__()
-        self.self_attention = AddNorm(MultiHeadAttention(d_model, num_heads), d_model)
-        self.memory_attention = AddNorm(MultiHeadAttention(d_model, num_heads), d_model)
-        self.feed_forward = AddNorm(PositionWiseFeedForwardNet(d_model, d_ff, dropout_p, ffnet_style), d_model)
+        self.amp = amp
+        self.self_attention = AddNorm(MultiHeadAttention(d_model, num_heads), d_model, pre_norm)
+        self.memory_attention = AddNorm(MultiHeadAttention(d_model, num_heads), d_model, pre_norm)
+        self.feed_forward = AddNorm(
+            PositionWiseFeedForwardNet(d_model, d_ff, dropout_p, ffnet_style), d_model, pre_norm
+        )
 
     def forward(
             self,
@@ -77,7 +102,11 @@ class SpeechTransformerDecoderLayer(nn.Module):
             self_attn_mask: Optional[Any] = None,           # B x T_input x T_input
             memory_mask: Optional[Any] = None               # B x T_input x T_output
     ) -> Tuple[Tensor, Tensor, Tensor]:
-        output, self_attn = self.self_attention(inputs, inputs, inputs, self_attn_mask)
-        output, memory_attn = self.memory_attention(output, memory, memory, memory_mask)
-        output = self.feed_forward(output)
-        return output, self_attn, memory_attn
+        with torch.autocast(device_type=inputs.device.type, dtype=torch.bfloat16, enabled=self.amp):
+            # is_causal lets the fused attention kernel skip the masked future positions
+            is_causal = self_attn_mask is None
+            output, self_attn = self.self_attention(inputs, inputs, inputs, self_attn_mask, is_causal=is_causal)
+            output, memory_attn = self.memory_attention(output, memory, memory, memory_mask)
+            output = self.feed_forward(output)
+
+        return (output.float() if self.amp else output), self_attn, memory_attn
@@ -6,31 +6,66 @@
 import torch
 from torch import Tensor
 from typing import Any, Optional
+from models.attention import get_causal_mask
+
+
+@torch.jit.script
+def _get_non_pad_mask_by_lengths(inputs: Tensor, input_lengths: Tensor) -> Tensor:
+    """ B x T boolean mask, True at positions shorter than the length """
+    positions = torch.arange(inputs.size(1), device=inputs.device)
+    return positions.unsqueeze(0) < input_lengths.to(inputs.device).unsqueeze(1)
+
+
+@torch.jit.script
+def _get_non_pad_mask_by_pad_id(inputs: Tensor, pad_id: int) -> Tensor:
+    """ B x T boolean mask, True at tokens other than pad_id """
+    return inputs.ne(pad_id)
+
+
+@torch.jit.script
+def _get_attn_pad_mask(inputs: Tensor, input_lengths: Tensor) -> Tensor:
+    """ B x 1 x T boolean mask, True at positions past the length """
+    positions = torch.arange(inputs.size(1), device=inputs.device)
+    return (positions.unsqueeze(0) >= input_lengths.to(inputs.device).unsqueeze(1)).unsqueeze(1)
+
+
+@torch.jit.script
+def _get_decoder_self_attn_mask(seq_k: Tensor, causal_mask: Tensor, pad_id: int) -> Tensor:
+    """ B x 1 x Lk key padding mask | Lq x Lk causal mask, broadcast into a single B x Lq x Lk boolean tensor """
+    return seq_k.eq(pad_id).unsqueeze(1) | causal_mask
 
 
 def get_non_pad_mask(inputs: Tensor, input_lengths: Optional[Any] = None, pad_id: int = None) -> Tensor:
-    """ Padding position is set to 0, either use input_lengths or pad_id """
+    """
+    Padding position is set to False, either use input_lengths or pad_id.
+    The mask is boolean, consumers zero out padding with ``masked_fill_(~mask, 0.)`` instead of a multiply.
+    """
     assert (input_lengths is None and pad_id is not None) or (input_lengths is not None and pad_id is None)
 
     if input_lengths is not None:
-        batch_size = inputs.size(0)
-
-        if len(inputs.size()) == 2:
-            non_pad_mask = inputs.new_ones(inputs.size())  # B x T
-        else:
-            non_pad_mask = inputs.new_ones(inputs.size()[:-1])  # B x T
-
-        for i in range(batch_size):
-            non_pad_mask[i, input_lengths[i]:] = 0
+        input_lengths = torch.as_tensor(input_lengths, device=inputs.device)
+        non_pad_mask = _get_non_pad_mask_by_lengths(inputs, input_lengths)  # B x T
 
     if pad_id is not None:
         assert inputs.dim() == 2
-        non_pad_mask = inputs.ne(pad_id).float()
+        non_pad_mask = _get_non_pad_mask_by_pad_id(inputs, pad_id)
 
     return non_pad_mask.unsqueeze(-1)
 
 
-def get_decoder_self_attn_mask(seq_k: Tensor, seq_q: Tensor, pad_id):
+def get_attn_bias(mask: Tensor, dtype: torch.dtype = torch.float32) -> Tensor:
+    """
+    Converts a boolean mask (masked position is set to True) into an additive attention bias,
+    built once per forward and shared by every layer that adds it to the attention scores.
+
+    Examples::
+        >>> get_attn_bias(torch.tensor([[False, False, True]]))
+        tensor([[0., 0., -inf]])
+    """
+    return torch.zeros(mask.size(), dtype=dtype, device=mask.device).masked_fill_(mask, float('-inf'))
+
+
+def get_decoder_self_attn_mask(seq_k: Tensor, seq_q: Tensor, pad_id: int) -> Tensor:
     """
     For masking the decoder self attention
 
@@ -60,78 +95,25 @@ def get_decoder_self_attn_mask(seq_k: Tensor, seq_q: Tensor, pad_id):
                  [False, False, False, False, False, False,  True],
                  [False, False, False, False, False, False,  True]]])
     """
-    def get_attn_key_pad_mask(seq_k, seq_q, pad_id):
-        """ For masking out the padding part of key sequence. """
-
-        # Expand to fit the shape of key query attention matrix.
-        len_q = seq_q.size(1)
-        padding_mask = seq_k.eq(pad_id)
-        padding_mask = padding_mask.unsqueeze(1).expand(-1, len_q, -1)  # b x lq x lk
-
-        return padding_mask
-
-    def get_subsequent_mask(inputs: Tensor) -> Tensor:
-        """
-        Makes subsequent masking like following:
-
-        Examples::
-            >>> get_subsequent_mask(inputs)
-            tensor([[[False,  True,  True,  True,  True,  True,  True],
-                     [False, False,  True,  True,  True,  True,  True],
-                     [False, False, False,  True,  True,  True,  True],
-                     [False, False, False, False,  True,  True,  True],
-                     [False, False, False, False, False,  True,  True],
-                     [False, False, False, False, False, False,  True],
-                     [False, False, False, False, False, False, False]],
-
-                    [[False,  True,  True,  True,  True,  True,  True],
-                     [False, False,  True,  True,  True,  True,  True],
-                     [False, False, False,  True,  True,  True,  True],
-                     [False, False, False, False,  True,  True,  True],
-                     [False, False, False, False, False,  True,  True],
-                     [False, False, False, False, False, False,  True],
-                     [False, False, False, False, False, False, False]],
-
-                    [[False,  True,  True,  True,  True,  True,  True],
-                     [False, False,  True,  True,  True,  True,  True],
-                     [False, False, False,  True,  True,  True,  True],
-                     [False, False, False, False,  True,  True,  True],
-                     [False, False, False, False, False,  True,  True],
-                     [False, False, False, False, False, False,  True],
-                     [False, False, False, False, False, False, False]]])
-        """
-
-        batch_size, seq_length = inputs.size()
-        subsequent_mask = torch.triu(torch.ones((seq_length, seq_length), device=inputs.device, dtype=torch.uint8), diagonal=1)
-        subsequent_mask = subsequent_mask.unsqueeze(0).expand(batch_size, -1, -1)  # BxTxT
-
-        return subsequent_mask.bool()
-
-    return get_attn_key_pad_mask(seq_k, seq_q, pad_id) | get_subsequent_mask(seq_k)
-
-
-def get_attn_pad_mask(inputs, input_lengths, expand_length):
+    len_q, len_k = seq_q.size(1), seq_k.size(1)
+    # the causal mask cache is a Python dict, so only the elementwise part runs as TorchScript
+    return _get_decoder_self_attn_mask(seq_k, get_causal_mask(len_k, seq_k.device)[:len_q], pad_id)
+
+
+def get_attn_pad_mask(inputs: Tensor, input_lengths: Any, expand_length: int) -> Tensor:
     """
     mask position is set to 1
 
+    The mask is returned as N x 1 x Ti and broadcasts over the query (and head) dimensions inside the attention,
+    so no N x Lq x Ti tensor is ever materialized. ``expand_length`` is kept for compatibility and unused.
+
     Examples::
         >>> get_attn_pad_mask(inputs, input_lengths, expand_length)
-        tensor([[[False, False, False, False, False,  True,  True,  True,  True],
-                 [False, False, False, False, False,  True,  True,  True,  True],
-                 [False, False, False, False, False,  True,  True,  True,  True]],
+        tensor([[[False, False, False, False, False,  True,  True,  True,  True]],
 
-                [[False, False, False, False, False, False,  True,  True,  True],
-                 [False, False, False, False, False, False,  True,  True,  True],
-                 [False, False, False, False, False, False,  True,  True,  True]],
+                [[False, False, False, False, False, False,  True,  True,  True]],
 
-                [[False, False, False, False, False, False, False, False,  True],
-                 [False, False, False, False, False, False, False, False,  True],
-                 [False, False, False, False, False, False, False, False,  True]]])
+                [[False, False, False, False, False, False, False, False,  True]]])
 
     """
-    # N x Ti x 1
-    non_pad_mask = get_non_pad_mask(inputs, input_lengths=input_lengths)
-    # N x Ti, lt(1) like not operation
-    pad_mask = non_pad_mask.squeeze(-1).lt(1)
-    attn_mask = pad_mask.unsqueeze(1).expand(-1, expand_length, -1)
-    return attn_mask
+    return _get_attn_pad_mask(inputs, torch.as_tensor(input_lengths, device=inputs.device))
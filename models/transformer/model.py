@@ -20,6 +20,7 @@ from typing import (
     Tuple,
     Union,
 )
+from models.attention import FUSED_ATTENTION_AVAILABLE
 from models.extractor import (
     VGGExtractor,
     DeepSpeech2Extractor,
@@ -60,6 +61,8 @@ class SpeechTransformer(nn.Module):
         dropout_p (float): dropout probability (default: 0.3)
         ffnet_style (str): if poswise_ffnet is 'ff', position-wise feed forware network to be a feed forward,
             otherwise, position-wise feed forward network to be a convolution layer. (default: ff)
+        pre_norm (bool): if True, applies layer normalization before each sub-layer instead of after (default: False)
+        amp (bool): if True, runs the encoder / decoder layers under bfloat16 autocast (default: False)
 
     Inputs: inputs, input_lengths, targets, teacher_forcing_ratio
         - **inputs** (torch.Tensor): tensor of sequences, whose length is the batch size and within which
@@ -86,7 +89,9 @@ class SpeechTransformer(nn.Module):
             dropout_p: float = 0.3,                 # dropout probability
             ffnet_style: str = 'ff',                # feed forward network style 'ff' or 'conv'
             extractor: str = 'vgg',                 # CNN extractor [vgg, ds2]
-            joint_ctc_attention: bool = False       # flag indication whether to apply joint ctc attention
+            joint_ctc_attention: bool = False,      # flag indication whether to apply joint ctc attention
+            pre_norm: bool = False,                 # if True, applies layer normalization before each sub-layer
+            amp: bool = False                       # if True, runs the transformer layers under bfloat16 autocast
     ) -> None:
         super(SpeechTransformer, self).__init__()
 
@@ -119,6 +124,8 @@ class SpeechTransformer(nn.Module):
             ffnet_style=ffnet_style,
             dropout_p=dropout_p,
             pad_id=pad_id,
+            pre_norm=pre_norm,
+            amp=amp,
         )
 
         if self.joint_ctc_attention:
@@ -138,7 +145,9 @@ class SpeechTransformer(nn.Module):
             ffnet_style=ffnet_style,
             dropout_p=dropout_p,
             pad_id=pad_id,
-            eos_id=eos_id
+            eos_id=eos_id,
+            pre_norm=pre_norm,
+            amp=amp,
         )
         self.decoder_fc = Linear(d_model, num_classes)
 
@@ -189,6 +198,8 @@ class SpeechTransformerEncoder(nn.Module):
         ffnet_style: style of feed forward network [ff, conv] (default: ff)
         dropout_p:  probability of dropout (default: 0.3)
         pad_id: identification of pad token (default: 0)
+        pre_norm: if True, applies layer normalization before each sub-layer instead of after (default: False)
+        amp: if True, runs the encoder layers under bfloat16 autocast (default: False)
 
     Inputs:
         - **inputs**: list of sequences, whose length is the batch size and within which each sequence is list of tokens
@@ -205,6 +216,8 @@ class SpeechTransformerEncoder(nn.Module):
             ffnet_style: str = 'ff',        # style of feed forward network [ff, conv]
             dropout_p: float = 0.3,         # probability of dropout
             pad_id: int = 0,                # identification of pad token
+            pre_norm: bool = False,         # if True, applies layer normalization before each sub-layer
+            amp: bool = False,              # if True, runs the encoder layers under bfloat16 autocast
     ) -> None:
         super(SpeechTransformerEncoder, self).__init__()
         self.d_model = d_model
@@ -215,18 +228,25 @@ class SpeechTransformerEncoder(nn.Module):
         self.input_norm = LayerNorm(d_model)
         self.input_dropout = nn.Dropout(p=dropout_p)
         self.positional_encoding = PositionalEncoding(d_model)
-        self.layers = nn.ModuleList(
-            [SpeechTransformerEncoderLayer(d_model, num_heads, d_ff, dropout_p, ffnet_style) for _ in range(num_layers)]
-        )
+        self.layers = nn.ModuleList([
+            SpeechTransformerEncoderLayer(d_model, num_heads, d_ff, dropout_p, ffnet_style, pre_norm, amp)
+            for _ in range(num_layers)
+        ])
+        # pre-norm layers leave the residual stream un-normalized, so the stack ends with a layer normalization
+        self.output_norm = LayerNorm(d_model) if pre_norm else None
 
     def forward(self, inputs: Tensor, input_lengths: Tensor = None) -> Tuple[Tensor, list]:
         self_attn_mask = get_attn_pad_mask(inputs, input_lengths, inputs.size(1))
 
-        output = self.input_dropout(self.input_norm(self.input_proj(inputs)) + self.positional_encoding(inputs.size(1)))
+        output = self.input_norm(self.input_proj(inputs)).add_(self.positional_encoding(inputs.size(1)))
+        output = self.input_dropout(output)
 
         for layer in self.layers:
             output, attn = layer(output, self_attn_mask)
 
+        if self.output_norm is not None:
+            output = self.output_norm(output)
+
         return output
 
 
@@ -246,6 +266,8 @@ class SpeechTransformerDecoder(nn.Module):
         dropout_p: probability of dropout
         pad_id: identification of pad token
         eos_id: identification of end of sentence token
+        pre_norm: if True, applies layer normalization before each sub-layer instead of after
+        amp: if True, runs the decoder layers under bfloat16 autocast
     """
 
     def __init__(
@@ -258,7 +280,9 @@ class SpeechTransformerDecoder(nn.Module):
             ffnet_style: str = 'ff',        # style of feed forward network
             dropout_p: float = 0.3,         # probability of dropout
             pad_id: int = 0,                # identification of pad token
-            eos_id: int = 2                 # identification of end of sentence token
+            eos_id: int = 2,                # identification of end of sentence token
+            pre_norm: bool = False,         # if True, applies layer normalization before each sub-layer
+            amp: bool = False               # if True, runs the decoder layers under bfloat16 autocast
     ) -> None:
         super(SpeechTransformerDecoder, self).__init__()
         self.d_model = d_model
@@ -268,20 +292,32 @@ class SpeechTransformerDecoder(nn.Module):
         self.positional_encoding = PositionalEncoding(d_model)
         self.input_dropout = nn.Dropout(p=dropout_p)
         self.layers = nn.ModuleList([
-            SpeechTransformerDecoderLayer(d_model, num_heads, d_ff, dropout_p, ffnet_style) for _ in range(num_layers)
+            SpeechTransformerDecoderLayer(d_model, num_heads, d_ff, dropout_p, ffnet_style, pre_norm, amp)
+            for _ in range(num_layers)
         ])
+        self.output_norm = LayerNorm(d_model) if pre_norm else None
         self.pad_id = pad_id
         self.eos_id = eos_id
 
     def forward(self, inputs: Tensor, input_lengths: Optional[Any] = None, memory: Tensor = None):
         batch_size, output_length = inputs.size(0), inputs.size(1)
 
-        self_attn_mask = get_decoder_self_attn_mask(inputs, inputs, self.pad_id)
+        # masks are built once here and shared by every layer, the causal part itself is cached per device
+        if FUSED_ATTENTION_AVAILABLE:
+            # targets are right-padded, so under the causal attention no real position attends to a pad key
+            # and the self-attention layers need no (B x T x T) mask, they request is_causal instead
+            self_attn_mask = None
+        else:
+            self_attn_mask = get_decoder_self_attn_mask(inputs, inputs, self.pad_id)
         memory_mask = get_attn_pad_mask(memory, input_lengths, output_length)
 
-        output = self.input_dropout(self.embedding(inputs) + self.positional_encoding(inputs.size(1)))
+        output = self.embedding(inputs).add_(self.positional_encoding(inputs.size(1)))
+        output = self.input_dropout(output)
 
         for layer in self.layers:
             output, self_attn, memory_attn = layer(output, memory, self_attn_mask, memory_mask)
 
+        if self.output_norm is not None:
+            output = self.output_norm(output)
+
         return output
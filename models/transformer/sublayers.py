@@ -16,15 +16,32 @@ class AddNorm(nn.Module):
     Add & Normalization layer proposed in "Attention Is All You Need".
     Transformer employ a residual connection around each of the two sub-layers,
     (Multi-Head Attention & Feed-Forward) followed by layer normalization.
+
+    With pre_norm, the layer normalization is applied to the sub-layer input instead (x + sublayer(LayerNorm(x))),
+    which leaves the residual stream un-normalized and is more stable under mixed precision training.
+    A stack of pre-norm layers should be followed by a final layer normalization.
     """
-    def __init__(self, sublayer: nn.Module, d_model: int = 512) -> None:
+    def __init__(self, sublayer: nn.Module, d_model: int = 512, pre_norm: bool = False) -> None:
         super(AddNorm, self).__init__()
         self.sublayer = sublayer
         self.layer_norm = LayerNorm(d_model)
+        self.pre_norm = pre_norm
 
-    def forward(self, *args):
+    def forward(self, *args, **kwargs):
         residual = args[0]
-        output = self.sublayer(*args)
+
+        if self.pre_norm:
+            normed = self.layer_norm(residual)
+            # arguments aliasing the residual (e.g. self attention) take the same normalized tensor
+            args = tuple(normed if arg is residual else arg for arg in args)
+            output = self.sublayer(*args, **kwargs)
+
+            if isinstance(output, tuple):
+                return output[0] + residual, output[1]
+
+            return output + residual
+
+        output = self.sublayer(*args, **kwargs)
 
         if isinstance(output, tuple):
             return self.layer_norm(output[0] + residual), output[1]